@@ -0,0 +1,6 @@
+import pytest
+
+
+@pytest.fixture(scope='session')
+def tdir_root(tmp_path_factory):
+    return tmp_path_factory.mktemp('tdir')
@@ -100,32 +100,87 @@ either be used as a context manager, or a decorator for functions or classes.
 from __future__ import annotations
 
 import dataclasses as dc
+import functools
 import os
-import shutil
 import sys
 import tempfile
 import threading
-import traceback
 import typing as t
 from pathlib import Path
 from types import TracebackType
-from unittest.mock import patch
 
-import dek
 import xmod
 
 __all__ = 'tdir', 'fill'
 
 Arg = t.Union[str, Path, t.Dict[str, t.Any]]
 
+# A file's contents or a file or directory to copy
+_File = t.Union[bytes, bytearray, Path]
+
+# A _File, a str to encode, or None for a directory
+_Payload = t.Union[_File, str, None]
+_Leaves = t.List[t.Tuple[str, _Payload]]
+_Items = t.List[t.Tuple[str, t.Any]]
+_T = t.TypeVar('_T')
+
+
+class _Plan(t.NamedTuple):
+    # Directories to create, parents first, then the files to write into them
+    directories: t.List[str]
+    files: t.List[t.Tuple[str, _File]]
+
+
+_PID_SUFFIX = f'-{os.getpid()}'
+
+
+def _reset_pid_suffix() -> None:
+    global _PID_SUFFIX
+    _PID_SUFFIX = f'-{os.getpid()}'
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pid_suffix)
+
+
+def _suffix() -> str:
+    # The thread id only helps tell directories apart when there are threads
+    if threading.active_count() == 1:
+        return _PID_SUFFIX
+    return f'-{threading.get_ident()}{_PID_SUFFIX}'
+
+
+# Linux in-memory filesystems, and the free space to leave on one beyond
+# the files being written
+_TMPFS_CANDIDATES = '/dev/shm', '/run/user/{uid}'
+_TMPFS_HEADROOM = 8 * 1024 * 1024
+
+# Setting any of these chooses where tempfile puts things, so tmpfs isn't used
+_TEMP_VARIABLES = 'TMPDIR', 'TEMP', 'TMP'
+
+# tempfile.gettempdir() caches one of these in tempfile.tempdir by itself, so
+# only other values there count as set
+_TEMP_DEFAULTS = '/tmp', '/var/tmp', '/usr/tmp'
+
+# Fewer files than this are not worth starting a thread pool for
+_PARALLEL_MIN = 4
+
+# Payloads at least this large are allocated in one go before writing
+_PREALLOCATE_MIN = 1024 * 1024
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
 
 @xmod.xmod
 def tdir(
     *args: Arg,
+    backing: str = '',
     chdir: bool = True,
     clear: bool = False,
-    methods: str = patch.TEST_PREFIX,
+    methods: str = 'test',
+    parallel: bool = False,
     save: bool = False,
+    share: bool = False,
     use_dir: str = '',
     **kwargs: Arg,
 ) -> '_Tdir':
@@ -141,6 +196,21 @@ def tdir(
         Files to put into the temporary directory.
         See the documentation for `tdir.fill()`
 
+      backing:
+        Where temporary directories are created.
+
+        `'tmpfs'` uses a writable in-memory filesystem like `/dev/shm` if one
+        exists with room for the files and isn't mounted `noexec`, and
+        neither `tempfile.tempdir` nor any of the `TMPDIR`, `TEMP` or `TMP`
+        environment variables is set.  Otherwise, it falls back to the
+        location `tempfile` would use, which can be selected directly with
+        `'default'`.  Any other value is the directory to use.
+
+        If empty (the default), the `TDIR_BASE` environment variable is used
+        if it is set, otherwise `'tmpfs'`.
+
+        `use_dir` takes precedence over `backing`.
+
       chdir:
         If true (the default), change the working directory to the tdir at
         the start of the operation and restore the original working directory
@@ -153,6 +223,10 @@ def tdir(
         The default decorates only class methods that start with the string
         `test` - exactly like `unittest.mock.patch` does.
 
+      parallel:
+        If true, files are written using a pool of threads.  See the
+        documentation for `tdir.fill()`
+
       use_dir:
         If non-empty, `use_dir` is used instead of a temp directory (and is
         not removed at the end) - for example, `use_dir='.'` puts everything in
@@ -161,56 +235,98 @@ def tdir(
       save:
         If set to true, the temp directory is not deleted at end and its name
         is printed to `sys.stderr`
-    """
-    td: _Tdir
-
-    @dek.dek(methods=methods)  # type: ignore[misc]
-    def call(func: t.Callable[..., None], *args: t.Any, **kwargs: t.Any) -> None:
-        with td:
-            func(*args, **kwargs)
 
+      share:
+        If set to true, the files are written once, into a template directory
+        that lives as long as the `tdir` does, and each later use copies that
+        template instead of writing the files again.  `Path` values are read
+        only on first use.
+    """
     is_decorator = len(args) == 1 and callable(args[0]) and not kwargs
     if is_decorator:
         decorator = args[0]
         args = ()
 
-    d = dict(locals())
-    fields = (f.name for f in dc.fields(_Tdir))
-    td = _Tdir(**{f: d[f] for f in fields})
+    td = _Tdir(
+        args=args,
+        backing=backing,
+        chdir=chdir,
+        clear=clear,
+        kwargs=kwargs,
+        methods=methods,
+        parallel=parallel,
+        save=save,
+        share=share,
+        use_dir=use_dir,
+    )
     return td(decorator) if is_decorator else td
 
 
 @dc.dataclass
 class _Tdir:
     args: t.Sequence[Arg]
-    call: t.Callable[..., '_Tdir']
+    backing: str
     chdir: bool
     clear: bool
     kwargs: t.Dict[str, Arg]
+    methods: str
+    parallel: bool
     save: bool
+    share: bool
     use_dir: str
 
+    __slots__ = (
+        'args',
+        'backing',
+        'chdir',
+        'clear',
+        'kwargs',
+        'methods',
+        'parallel',
+        'save',
+        'share',
+        'use_dir',
+        '_shared',
+        '_parent',
+        'directory',
+        'old_directory',
+        '_plan',
+        '_size',
+        '_template',
+        '_call',
+    )
+
+    def __post_init__(self) -> None:
+        # When decorating, each call gets a new subdirectory of a shared parent
+        self._shared = False
+        self._parent: t.Optional[tempfile.TemporaryDirectory[str]] = None
+        self._plan = _flatten(self.args, self.kwargs)
+        # Bytes to write, not counting Path values, which are read later
+        self._size = sum(len(p) for _, p in self._plan.files if not isinstance(p, Path))
+        self._template = ''
+        self._call: t.Optional[t.Callable[..., _Tdir]] = None
+
     def __enter__(self) -> Path:
         if self.use_dir:
-            self.directory = Path(self.use_dir)
+            directory = os.fspath(self.use_dir)
+            os.makedirs(directory, exist_ok=True)
+        elif self._shared and not self.save:
+            directory = tempfile.mkdtemp(dir=self._parent_name())
         else:
-            suffix = f'-{threading.get_ident()}-{os.getpid()}'
-            self._td = tempfile.TemporaryDirectory(suffix=suffix)
-            self.directory = Path(self._td.__enter__())
-
-        if self.clear:
-            for f in self.directory.iterdir():
-                if f.is_dir():
-                    shutil.rmtree(f)
-                else:
-                    f.unlink()
+            directory = tempfile.mkdtemp(suffix=_suffix(), dir=self._backing_dir())
 
-        fill(self.directory, *self.args, **self.kwargs)
+        try:
+            self._fill(directory)
+        except BaseException:
+            if not (self.use_dir or self.save):
+                _rmtree(directory)
+            raise
 
         if self.chdir:
             self.old_directory = os.getcwd()
-            os.chdir(self.directory)
+            os.chdir(directory)
 
+        self.directory = Path(directory)
         return self.directory
 
     def __exit__(
@@ -222,21 +338,94 @@ class _Tdir:
         if self.chdir:
             try:
                 os.chdir(self.old_directory)
-            except Exception:  # pragma: no cover
-                traceback.print_exc()
+            except OSError as e:  # pragma: no cover
+                import warnings
+
+                warnings.warn(f'tdir could not restore {self.old_directory}: {e}')
 
         if self.save:
             msg = f'🗃 tdir saving {self.directory.absolute()} 🗃'
             print(msg, file=sys.stderr)
 
         elif not self.use_dir:
-            self._td.__exit__(exc_type, exc_val, exc_tb)
+            _rmtree(os.fspath(self.directory))
+
+    def _fill(self, directory: str) -> None:
+        if self.clear:
+            import shutil
+
+            # Unlike _rmtree, this doesn't force its way past permissions,
+            # because this directory belongs to the caller
+            with os.scandir(directory) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        shutil.rmtree(e.path)
+                    else:
+                        os.unlink(e.path)
+
+        if not (self._plan.directories or self._plan.files):
+            return
+
+        if not self.share:
+            _write_all(directory, self._plan, self.parallel)
+            return
+
+        import shutil
+
+        if not self._template:
+            template = os.path.join(self._parent_name(), 'template')
+            # copytree gives each copy the template's mode, so keep it private
+            # like a directory from mkdtemp
+            os.mkdir(template, 0o700)
+            try:
+                _write_all(template, self._plan, self.parallel)
+            except BaseException:
+                _rmtree(template)
+                raise
+            self._template = template
+
+        shutil.copytree(
+            self._template,
+            directory,
+            copy_function=_copy2,
+            dirs_exist_ok=True,
+        )
+
+    def _backing_dir(self) -> t.Optional[str]:
+        backing = self.backing or os.environ.get('TDIR_BASE') or 'tmpfs'
+        if backing == 'tmpfs':
+            return _tmpfs(self._size)
+        if backing == 'default':
+            return None
+        return os.path.abspath(backing)
+
+    def _parent_name(self) -> str:
+        if self._parent is None:
+            self._parent = tempfile.TemporaryDirectory(
+                suffix=_suffix(), dir=self._backing_dir()
+            )
+        return self._parent.name
 
     def __call__(self, *args: t.Any, **kwargs: t.Any) -> _Tdir:
-        return self.call(*args, **kwargs)
+        self._shared = True
+        if self._call is None:
+            import dek
+
+            @dek.dek(methods=self.methods)  # type: ignore[misc]
+            def call(
+                func: t.Callable[..., None], *args: t.Any, **kwargs: t.Any
+            ) -> None:
+                with self:
+                    func(*args, **kwargs)
 
+            self._call = call
 
-def fill(_root: t.Union[str, Path], *args: Arg, **kwargs: Arg) -> None:
+        return self._call(*args, **kwargs)
+
+
+def fill(
+    _root: t.Union[str, Path], *args: Arg, _parallel: bool = False, **kwargs: Arg
+) -> None:
     """
     Recursively fills a directory from file names and optional values.
 
@@ -265,42 +454,314 @@ def fill(_root: t.Union[str, Path], *args: Arg, **kwargs: Arg) -> None:
 
         If it's a Path, that file is copied to the target directory but with
         the key as its name.
+
+      _parallel:
+        If true, and there are several files, they are written from a pool of
+        threads.  This is usually slower than writing them in turn, except
+        perhaps for very large files on some filesystems.  If the same file is
+        given more than once, only the last value is written.
     """
-    _root = Path(_root)
+    if not args and len(kwargs) == 1:
+        ((k, v),) = kwargs.items()
+        data = _encode(v) if isinstance(v, str) else v
+        if isinstance(data, (bytes, bytearray)):
+            path = os.path.join(os.fspath(_root), k)
+            parent = os.path.dirname(path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            _write(path, data)
+            return
+
+    plan = _flatten(args, kwargs)
+    if plan.directories or plan.files:
+        root = os.fspath(_root)
+        os.makedirs(root, exist_ok=True)
+        _write_all(root, plan, _parallel)
+
+
+def _flatten(args: t.Sequence[Arg], kwargs: t.Dict[str, Arg]) -> _Plan:
+    # Paths in the plan are relative to the directory being filled
+    leaves: _Leaves = []
+
+    # A worklist of (parent, name, value), popped in the order given
+    items = _arg_items(args) + list(kwargs.items())
+    stack = [('', k, v) for k, v in reversed(items)]
+    while stack:
+        root, k, v = stack.pop()
+        if type(k) is str:
+            k = sys.intern(k)
+        collect = _COLLECTORS.get(type(v)) or _resolve_collector(type(v))
+        if collect is None:
+            raise TypeError('Do not understand type %s=%s' % (k, v))
+
+        path = os.path.join(root, k)
+        children = collect(path, v, leaves)
+        if children:
+            stack.extend((path, ck, cv) for ck, cv in reversed(children))
+
+    # A dict used as an ordered set, with each directory after its parent
+    directories: t.Dict[str, None] = {}
+    files: t.Dict[str, _File] = {}
+    encoded: t.Dict[str, bytes] = {}
+    for path, payload in leaves:
+        if payload is None:
+            directory = path
+        else:
+            directory = os.path.dirname(path)
+            if isinstance(payload, str):
+                if payload not in encoded:
+                    encoded[payload] = _encode(payload)
+                files[path] = encoded[payload]
+            else:
+                files[path] = payload
+
+        missing = []
+        while directory and directory not in directories:
+            missing.append(directory)
+            directory = os.path.dirname(directory)
+        directories.update(dict.fromkeys(reversed(missing)))
+
+    return _Plan(list(directories), list(files.items()))
+
+
+def _arg_items(args: t.Sequence[Arg]) -> _Items:
+    items: _Items = []
     for a in args:
         if isinstance(a, str):
-            a = {a.strip(): a}
+            items.append((a.strip(), a))
         elif isinstance(a, Path):
-            a = {a.name: a}
-        elif not isinstance(a, dict):
+            items.append((a.name, a))
+        elif isinstance(a, dict):
+            items.extend(a.items())
+        else:
             raise TypeError('Do not understand type %s of %s' % (a, type(a)))
-        fill(_root, **a)
-
-    for k, v in kwargs.items():
-        rk = _root / k
-        is_dir = isinstance(v, (dict, list, tuple))
-        to_make = rk if is_dir else rk.parent
-        to_make.mkdir(parents=True, exist_ok=True)
-
-        if isinstance(v, str):
-            if not v.endswith('\n'):
-                v += '\n'
-            rk.write_text(v)
-
-        elif isinstance(v, Path):
-            if v.is_dir():
-                shutil.copytree(str(v), str(rk))
-            else:
-                shutil.copyfile(str(v), str(rk))
+    return items
+
+
+# Each collector adds its leaves and returns any children still to collect
+
+
+def _collect_leaf(path: str, v: _Payload, leaves: _Leaves) -> None:
+    leaves.append((path, v))
+
+
+def _collect_dict(path: str, v: t.Dict[str, Arg], leaves: _Leaves) -> _Items:
+    leaves.append((path, None))
+    return list(v.items())
+
+
+def _collect_sequence(path: str, v: t.Sequence[Arg], leaves: _Leaves) -> _Items:
+    leaves.append((path, None))
+    return _arg_items(v)
+
+
+_COLLECTORS: t.Dict[type, t.Callable[..., t.Optional[_Items]]] = {
+    str: _collect_leaf,
+    bytes: _collect_leaf,
+    bytearray: _collect_leaf,
+    dict: _collect_dict,
+    list: _collect_sequence,
+    tuple: _collect_sequence,
+    type(Path()): _collect_leaf,
+    Path: _collect_leaf,
+}
 
-        elif isinstance(v, (bytes, bytearray)):
-            rk.write_bytes(v)
 
-        elif isinstance(v, dict):
-            fill(rk, **v)
+def _resolve_collector(
+    v_type: type,
+) -> t.Optional[t.Callable[..., t.Optional[_Items]]]:
+    # Subclasses of known types are looked up once, then remembered
+    for c_type, collect in tuple(_COLLECTORS.items()):
+        if issubclass(v_type, c_type):
+            _COLLECTORS[v_type] = collect
+            return collect
+    return None
 
-        elif isinstance(v, (list, tuple)):
-            fill(rk, *v)
 
+def _tmpfs(size: int) -> t.Optional[str]:
+    if any(os.environ.get(v) for v in _TEMP_VARIABLES):
+        return None
+    if tempfile.tempdir not in (None, *_TEMP_DEFAULTS):
+        return None
+
+    for directory in _tmpfs_candidates():
+        try:
+            st = os.statvfs(directory)
+        except OSError:
+            continue
+        if st.f_bavail * st.f_frsize >= size + _TMPFS_HEADROOM:
+            return directory
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _tmpfs_candidates() -> t.Tuple[str, ...]:
+    if not sys.platform.startswith('linux'):
+        return ()
+    candidates = (c.format(uid=os.getuid()) for c in _TMPFS_CANDIDATES)
+    return tuple(c for c in candidates if _is_usable(c))
+
+
+def _is_usable(directory: str) -> bool:
+    # Scripts written into a tdir must be able to run, so skip noexec mounts
+    try:
+        if not os.access(directory, os.W_OK | os.X_OK):
+            return False
+        return not os.statvfs(directory).f_flag & os.ST_NOEXEC
+    except OSError:
+        return False
+
+
+def _rmtree(path: str, parent: str = '') -> None:
+    # Like shutil.rmtree, but using the file types that os.scandir already read.
+    # Like TemporaryDirectory.cleanup, skip anything that is already gone and
+    # reset permissions that get in the way
+    for e in _tolerant(_scandir, path, parent) or ():
+        if e.is_dir(follow_symlinks=False):
+            _rmtree(e.path, path)
         else:
-            raise TypeError('Do not understand type %s=%s' % (k, v))
+            _tolerant(os.unlink, e.path, path)
+    _tolerant(os.rmdir, path, parent)
+
+
+def _scandir(path: str) -> t.List[os.DirEntry[str]]:
+    with os.scandir(path) as it:
+        return list(it)
+
+
+def _tolerant(func: t.Callable[[str], _T], path: str, parent: str) -> t.Optional[_T]:
+    try:
+        try:
+            return func(path)
+        except PermissionError:
+            for p in (parent, path):
+                if p and not os.path.islink(p):
+                    if hasattr(os, 'chflags'):
+                        os.chflags(p, 0)
+                    os.chmod(p, 0o700)
+            return func(path)
+    except FileNotFoundError:
+        return None
+
+
+def _write_all(root: str, plan: _Plan, parallel: bool) -> None:
+    for directory in plan.directories:
+        try:
+            os.mkdir(os.path.join(root, directory))
+        except FileExistsError:
+            pass
+
+    def write_one(leaf: t.Tuple[str, _File]) -> None:
+        relative, payload = leaf
+        path = os.path.join(root, relative)
+        if isinstance(payload, Path):
+            source = os.fspath(payload)
+            if os.path.isdir(source):
+                import shutil
+
+                shutil.copytree(source, path, copy_function=_copy2)
+            else:
+                _copyfile(source, path)
+
+        else:
+            _write(path, payload)
+
+    if parallel and len(plan.files) >= _PARALLEL_MIN:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(min(32, len(plan.files))) as executor:
+            for _ in executor.map(write_one, plan.files):
+                pass
+    else:
+        for leaf in plan.files:
+            write_one(leaf)
+
+
+def _encode(v: str) -> bytes:
+    b = v.encode('utf-8')
+    if not b.endswith(b'\n'):
+        b += b'\n'
+    return b
+
+
+def _write(path: str, data: t.Union[bytes, bytearray]) -> None:
+    fd = os.open(path, _WRITE_FLAGS, 0o666)
+    try:
+        if len(data) >= _PREALLOCATE_MIN and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, len(data))
+            except OSError:
+                # Not supported by this filesystem
+                pass
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def _copyfile(src: str, dst: str) -> None:
+    if sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb', buffering=0) as fsrc:
+                # Opening src again as dst would truncate it, so leave that
+                # case to shutil.copyfile, which raises SameFileError
+                if not _is_same_file(os.fstat(fsrc.fileno()), dst):
+                    with open(dst, 'wb', buffering=0) as fdst:
+                        _copy_in_kernel(fsrc.fileno(), fdst.fileno())
+                    return
+        except OSError:
+            # Unsupported by this kernel or filesystem pair
+            pass
+
+    import shutil
+
+    shutil.copyfile(src, dst)
+
+
+def _is_same_file(st: os.stat_result, path: str) -> bool:
+    try:
+        return os.path.samestat(st, os.stat(path))
+    except OSError:
+        return False
+
+
+def _copy2(src: str, dst: str) -> None:
+    # shutil.copy2, but copying the data with _copyfile
+    import shutil
+
+    _copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _copy_in_kernel(src: int, dst: int) -> None:
+    # st_size is only a hint: files in /proc, for example, report 0
+    blocksize = max(os.fstat(src).st_size, 2**23)
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is not None:
+        try:
+            # Some filesystems copy nothing here rather than failing
+            if _copy_loop(copy_file_range, src, dst, blocksize):
+                return
+        except OSError:
+            os.lseek(src, 0, os.SEEK_SET)
+            os.lseek(dst, 0, os.SEEK_SET)
+            os.ftruncate(dst, 0)
+
+    def sendfile(src: int, dst: int, count: int) -> int:
+        return os.sendfile(dst, src, None, count)
+
+    _copy_loop(sendfile, src, dst, blocksize)
+
+
+def _copy_loop(
+    copy: t.Callable[[int, int, int], int], src: int, dst: int, blocksize: int
+) -> int:
+    total = 0
+    while True:
+        copied = copy(src, dst, blocksize)
+        if not copied:
+            return total
+        total += copied
@@ -1,67 +1,129 @@
+import inspect
 import os
 import shutil
 import sys
-import unittest
+import tempfile
 from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 
 import tdir
 
-CWD = Path().absolute()
+CWD = os.getcwd()
+
+
+def _not_cwd():
+    assert os.getcwd() != CWD
+
+
+def _read(p):
+    with open(p, 'rb') as f:
+        return f.read().decode()
+
+
+def test_methods_default():
+    assert inspect.signature(tdir).parameters['methods'].default == patch.TEST_PREFIX
 
 
 def test_simple_cwd():
-    with tdir('a', 'b', 'c') as td:
-        assert sorted(i.name for i in td.iterdir()) == ['a', 'b', 'c']
+    with tdir('a', 'b', 'c'):
+        assert sorted(os.listdir('.')) == ['a', 'b', 'c']
         for i in 'abc':
             assert Path(i).read_text() == i + '\n'
 
 
 def test_simple():
     with tdir('a', 'b', {'c': 'c'}, chdir=False) as td:
-        assert sorted(i.name for i in td.iterdir()) == ['a', 'b', 'c']
+        assert sorted(os.listdir(td)) == ['a', 'b', 'c']
         for i in 'abc':
-            assert (td / i).read_text() == i + '\n'
+            assert _read(td / i) == i + '\n'
             assert not Path(i).exists()
 
 
-def test_dict():
-    with tdir(one='ONE', two='TWO') as td:
-        assert sorted(i.name for i in td.iterdir()) == ['one', 'two']
-        for i in ('one', 'two'):
-            assert (td / i).read_text() == i.upper() + '\n'
+@pytest.mark.parametrize(
+    'kwargs, expected',
+    [
+        ({'one': 'ONE', 'two': 'TWO'}, [b'ONE\n', b'TWO\n']),
+        ({'one': b'ONE', 'two': bytearray(b'TWO')}, [b'ONE', b'TWO']),
+    ],
+    ids=['dict', 'binary'],
+)
+def test_fill(tdir_root, request, kwargs, expected):
+    td = tdir_root / request.node.callspec.id
+    tdir.fill(td, **kwargs)
+    assert sorted(os.listdir(td)) == ['one', 'two']
+    assert [(td / i).read_bytes() for i in ('one', 'two')] == expected
+
+
+def test_large(tdir_root):
+    td = tdir_root / 'large'
+    data = bytes(range(256)) * (tdir._PREALLOCATE_MIN // 256 + 1)
+    tdir.fill(td, 'a', large=data)
+    assert (td / 'large').stat().st_size == len(data)
+    assert (td / 'large').read_bytes() == data
+
+
+class _Str(str):
+    pass
+
+
+class _Dict(dict):
+    pass
+
+
+def test_subclasses(tdir_root):
+    for name in ('subclass1', 'subclass2'):
+        td = tdir_root / name
+        tdir.fill(td, a=_Str('A'), sub=_Dict(b=_Str('B')))
+        assert _read(td / 'a') == 'A\n'
+        assert _read(td / 'sub' / 'b') == 'B\n'
 
 
-def test_binary():
-    with tdir(one=b'ONE', two=bytearray(b'TWO')) as td:
-        assert sorted(i.name for i in td.iterdir()) == ['one', 'two']
-        for i in ('one', 'two'):
-            assert (td / i).read_bytes() == i.upper().encode()
+def test_list(tdir_root):
+    td = tdir_root / 'list'
+    tdir.fill(td, sub=['one', 'two'])
+    sub = td / 'sub'
+    assert sorted(os.listdir(sub)) == ['one', 'two']
+    for i in ('one', 'two'):
+        assert _read(sub / i) == i + '\n'
 
 
-def test_list():
-    with tdir(sub=['one', 'two']) as td:
-        sub = td / 'sub'
-        assert sorted(i.name for i in sub.iterdir()) == ['one', 'two']
-        for i in ('one', 'two'):
-            assert (sub / i).read_text() == i + '\n'
+def test_fill_single(tdir_root):
+    td = tdir_root / 'single' / 'missing'
+    tdir.fill(td, a='x')
+    tdir.fill(td, **{os.path.join('sub', 'a'): b'y'})
+    assert _read(td / 'a') == 'x\n'
+    assert (td / 'sub' / 'a').read_bytes() == b'y'
 
 
-def test_path1():
-    path = Path(__file__)
-    with tdir(path):
-        expected = path.read_text()
-        actual = Path(path.name).read_text()
-        assert expected == actual
+def test_plan_parents_first(monkeypatch):
+    import ntpath
 
+    items = {'a/b/c': 'c', 'e': {'f': 'f'}, 'a': {'d': 'd'}, 'g/h/i/j': 'j'}
+    with monkeypatch.context() as m:
+        m.setattr(os, 'path', ntpath)
+        m.setattr(os, 'sep', '\\')
+        directories = tdir._flatten((), items).directories
 
-def test_path2():
-    path = Path(__file__)
-    with tdir(foo=path):
-        expected = path.read_text()
-        actual = Path('foo').read_text()
-        assert expected == actual
+    assert sorted(directories) == ['a', 'a/b', 'e', 'g', 'g/h', 'g/h/i']
+    for i, d in enumerate(directories):
+        assert ntpath.dirname(d) in ('', *directories[:i])
+
+
+@pytest.fixture(scope='module')
+def self_source():
+    return _read(__file__)
+
+
+def test_path1(self_source):
+    with tdir(Path(__file__)):
+        assert _read(Path(__file__).name) == self_source
+
+
+def test_path2(self_source):
+    with tdir(foo=Path(__file__)):
+        assert _read('foo') == self_source
 
 
 def test_error():
@@ -94,6 +156,113 @@ def test_usedir():
     assert Path('one/one.txt').read_text() == 'ONE'
 
 
+@tdir
+def test_usedir_missing():
+    with tdir('a', use_dir='one/two'):
+        assert Path('a').read_text() == 'a\n'
+
+    assert Path('one/two/a').read_text() == 'a\n'
+
+
+@tdir
+def test_clear():
+    tdir.fill('one', 'a', sub={'b': 'b'})
+
+    with tdir('c', use_dir='one', clear=True):
+        assert sorted(os.listdir()) == ['c']
+
+    assert sorted(os.listdir('one')) == ['c']
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'geteuid') or os.geteuid() == 0,
+    reason='Permissions are not enforced',
+)
+@tdir
+def test_clear_read_only():
+    tdir.fill('one', sub={'b': 'b'})
+    os.chmod('one/sub', 0o555)
+    try:
+        with pytest.raises(PermissionError):
+            with tdir(use_dir='one', clear=True):
+                pass
+        assert Path('one/sub/b').exists()
+    finally:
+        os.chmod('one/sub', 0o755)
+
+
+@tdir
+def test_parallel():
+    files = {str(i): str(i) for i in range(10)}
+    tdir.fill('one', *files, _parallel=False, **files)
+    tdir.fill('two', *files, _parallel=True, **files)
+
+    assert sorted(os.listdir('one')) == sorted(os.listdir('two')) == sorted(files)
+    for f in files:
+        assert Path('one', f).read_text() == Path('two', f).read_text() == f + '\n'
+
+
+@tdir
+def test_backing():
+    base = Path('base').absolute()
+    base.mkdir()
+    with tdir('a', backing='base') as td:
+        assert td.parent == base
+        assert Path('a').read_text() == 'a\n'
+    assert os.listdir('base') == []
+
+    with patch.dict(os.environ, TDIR_BASE=str(base)):
+        with tdir() as td:
+            assert td.parent == base
+
+
+@pytest.mark.parametrize('variable', ['TMPDIR', 'TEMP', 'TMP'])
+def test_backing_tmpfs(monkeypatch, variable):
+    default = Path(tempfile.gettempdir())
+    for v in ('TDIR_BASE', 'TMPDIR', 'TEMP', 'TMP'):
+        monkeypatch.delenv(v, raising=False)
+
+    with tdir(backing='default') as td:
+        assert td.parent == default
+
+    with tdir() as td:
+        assert td.parent == Path(tdir._tmpfs(0) or default)
+    assert tdir._tmpfs(2**62) is None
+
+    monkeypatch.setenv(variable, str(default))
+    assert tdir._tmpfs(0) is None
+    with tdir(backing='tmpfs') as td:
+        assert td.parent == default
+
+
+def test_backing_tmpfs_tempdir(monkeypatch, tdir_root):
+    for v in ('TDIR_BASE', 'TMPDIR', 'TEMP', 'TMP'):
+        monkeypatch.delenv(v, raising=False)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tdir_root))
+
+    assert tdir._tmpfs(0) is None
+    with tdir() as td:
+        assert td.parent == tdir_root
+
+
+@pytest.mark.skipif(not hasattr(os, 'ST_NOEXEC'), reason='No mount flags')
+def test_tmpfs_noexec(monkeypatch):
+    class Statvfs:
+        f_flag = os.ST_NOEXEC
+
+    monkeypatch.setattr(os, 'statvfs', lambda path: Statvfs)
+    assert not tdir._is_usable(tempfile.gettempdir())
+
+
+@tdir
+def test_error_in_enter():
+    os.mkdir('base')
+    with pytest.raises(FileNotFoundError):
+        with tdir(foo=Path('missing'), backing='base'):
+            pass
+    assert os.listdir('base') == []
+
+
 def test_save():
     with tdir(save=True) as td:
         Path('one.txt').write_text('ONE')
@@ -102,57 +271,88 @@ def test_save():
     shutil.rmtree(td)
 
 
+def test_removed_in_body():
+    with tdir('a') as td:
+        shutil.rmtree(td)
+    assert not td.exists()
+
+    with tdir('a', sub={'b': 'b'}) as td:
+        os.rename('sub', 'moved')
+        os.unlink('a')
+    assert not td.exists()
+
+
+def test_read_only():
+    with tdir('a', sub={'b': 'b'}) as td:
+        os.chmod('a', 0o444)
+        os.chmod('sub/b', 0o444)
+        os.chmod('sub', 0o555)
+    assert not td.exists()
+
+
+@tdir
+def test_copy_same_file():
+    Path('a.txt').write_text('A')
+    with pytest.raises(shutil.SameFileError):
+        tdir.fill('.', Path('a.txt'))
+    with pytest.raises(shutil.SameFileError):
+        with tdir(Path('a.txt'), use_dir='.'):
+            pass
+    assert Path('a.txt').read_text() == 'A'
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='No /proc')
+def test_copy_unsized():
+    with tdir(status=Path('/proc/self/status')):
+        assert 'Name:' in Path('status').read_text()
+
+
 def test_copy_dir():
     root = Path(__file__).parent
     with tdir(root=root) as td:
-        copied = sorted(f.name for f in (td / 'root').iterdir())
-        original = sorted(f.name for f in root.iterdir())
-        assert copied == original
-
-
-def test_big():
-    items = {
-        'foo': {
-            '__init__.py': 'TEST = 32\n',
-            'toast.py': 'from . import TEST as TOAST\n',
-        },
-        'bar': {
-            '__init__.py': 'import foo\nTEST = foo.TEST - 9\n',
-            'toast.py': 'from . import TEST as TOAST\n',
-        },
-        'bang.py': 'TEST = 5\n',
-        'data': ['a', 'b', 'c'],
-    }
-
-    with tdir(**items) as td:
-        sys_path = sys.path[:]
-        sys.path.insert(0, str(td))
+        assert set(os.listdir(td / 'root')) == set(os.listdir(root))
 
-        try:
-            import bang
-            import bar.toast
-            import foo.toast
 
-        finally:
-            sys.path[:] = sys_path
+_BIG_ITEMS = {
+    'foo': {
+        '__init__.py': 'TEST = 32\n',
+        'toast.py': 'from . import TEST as TOAST\n',
+    },
+    'bar': {
+        '__init__.py': 'import foo\nTEST = foo.TEST - 9\n',
+        'toast.py': 'from . import TEST as TOAST\n',
+    },
+    'bang.py': 'TEST = 5\n',
+    'data': ['a', 'b', 'c'],
+}
 
-        assert bang.TEST == 5
-        assert foo.toast.TOAST == 32
-        assert bar.toast.TOAST == 23
-        for i in 'abc':
-            assert (td / 'data' / i).read_text() == i + '\n'
 
-    with tdir(items) as td:
-        sys_path = sys.path[:]
-        sys.path.insert(0, str(td))
+_BIG_MODULES = 'bang', 'foo', 'foo.toast', 'bar', 'bar.toast'
+
+
+@pytest.fixture
+def big_imports(tdir_root, monkeypatch):
+    monkeypatch.setattr(sys, 'pycache_prefix', str(tdir_root / 'pyc'))
+    yield
+    for m in _BIG_MODULES:
+        sys.modules.pop(m, None)
 
+
+@pytest.mark.parametrize(
+    'call',
+    [lambda i: tdir(**i), lambda i: tdir(i)],
+    ids=['kwargs', 'args'],
+)
+def test_big(call, big_imports):
+    with call(_BIG_ITEMS) as td:
+        sys.path.insert(0, str(td))
         try:
             import bang
             import bar.toast
             import foo.toast
 
         finally:
-            sys.path[:] = sys_path
+            sys.path.pop(0)
 
         assert bang.TEST == 5
         assert foo.toast.TOAST == 32
@@ -161,62 +361,145 @@ def test_big():
             assert (td / 'data' / i).read_text() == i + '\n'
 
 
+def test_decorator_shares_parent():
+    directories = []
+
+    @tdir('a')
+    def fn():
+        directories.append(Path.cwd())
+        assert Path('a').read_text() == 'a\n'
+
+    fn()
+    fn()
+    one, two = directories
+    assert one != two
+    assert one.parent == two.parent
+    assert not one.exists() and not two.exists()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='No fork')
+def test_decorator_fork():
+    r, w = os.pipe()
+
+    @tdir('a')
+    def fn(wait):
+        assert Path('a').read_text() == 'a\n'
+        if wait:
+            os.read(r, 1)
+
+    fn(False)
+    pids = []
+    for _ in range(2):
+        pid = os.fork()
+        if not pid:
+            code = 1
+            try:
+                os.close(w)
+                fn(True)
+                code = 0
+            finally:
+                os._exit(code)
+        pids.append(pid)
+
+    os.close(w)
+    assert [os.waitpid(pid, 0)[1] for pid in pids] == [0, 0]
+    os.close(r)
+
+
+def test_share():
+    contents = []
+
+    @tdir('a', sub={'b': b'b'}, share=True)
+    def fn():
+        contents.append(Path('a').read_text())
+        Path('a').write_text('changed')
+        assert Path('sub/b').read_bytes() == b'b'
+
+    fn()
+    fn()
+    assert contents == ['a\n', 'a\n']
+
+    with tdir('a', share=True) as td:
+        assert Path('a').read_text() == 'a\n'
+    assert not td.exists()
+
+
 @tdir
-class TestTdirClass1(unittest.TestCase):
+def test_share_error():
+    share = tdir(foo=Path('missing'), share=True)
+    for _ in range(2):
+        with pytest.raises(FileNotFoundError):
+            with share:
+                pass
+
+
+@tdir
+def test_share_mode():
+    tdir.fill('source', script='#!/bin/sh\n')
+    os.chmod('source/script', 0o755)
+    modes = []
+    for share in (False, True):
+        with tdir(copied=Path('source'), share=share):
+            modes.append(os.stat('copied/script').st_mode)
+    assert modes[0] == modes[1] == os.stat('source/script').st_mode
+
+
+def test_share_private():
+    modes = []
+    for share in (False, True):
+        with tdir('a', share=share) as td:
+            modes.append(td.stat().st_mode)
+    assert modes[0] == modes[1]
+
+
+@tdir
+class TestTdirClass1:
     def test_not_in_root(self):
-        cwd = str(Path().absolute())
-        assert cwd != CWD
+        _not_cwd()
 
 
 @tdir()
-class TestTdirClass2(unittest.TestCase):
+class TestTdirClass2:
     def test_not_in_root(self):
-        cwd = str(Path().absolute())
-        assert cwd != CWD
+        _not_cwd()
 
 
 @tdir('a', foo='bar')
-class TestTdirClass3(unittest.TestCase):
+class TestTdirClass3:
     test_variable = 3
 
     def test_values(self):
-        assert Path('a').read_text() == 'a\n'
-        assert Path('foo').read_text() == 'bar\n'
+        assert _read('a') == 'a\n'
+        assert _read('foo') == 'bar\n'
 
 
-class TestTdirClass4(unittest.TestCase):
+class TestTdirClass4:
     @tdir
-    def test_not_in_root0(self):
-        cwd = str(Path().absolute())
-        assert cwd != CWD
+    def test_not_in_root(self):
+        _not_cwd()
 
-    def test_not_in_root1(self):
-        @tdir
-        def fn():
-            cwd = str(Path().absolute())
-            assert cwd != CWD
+    @tdir('a', foo='bar')
+    def test_values(self):
+        assert _read('a') == 'a\n'
+        assert _read('foo') == 'bar\n'
 
-        fn()
 
-    @tdir()
-    def test_not_in_root2(self):
-        cwd = str(Path().absolute())
-        assert cwd != CWD
+@pytest.mark.parametrize('decorator', [tdir, tdir()], ids=['bare', 'called'])
+def test_decorate_function(decorator):
+    @decorator
+    def fn():
+        _not_cwd()
 
-    @tdir('a', foo='bar')
-    def test_values(self):
-        assert Path('a').read_text() == 'a\n'
-        assert Path('foo').read_text() == 'bar\n'
+    fn()
 
 
 @tdir('a', foo='bar', methods='test_keep')
-class TestTdirClassMethods(unittest.TestCase):
+class TestTdirClassMethods:
     def test_keep(self):
-        cwd = Path().absolute()
-        assert cwd != CWD
+        _not_cwd()
 
     def test_not(self):
-        cwd = Path().absolute()
+        cwd = os.getcwd()
         assert cwd == CWD
 
 
@@ -227,12 +510,13 @@ def test_recursive():
         f2 = d2 / 'one.txt'
         f2.write_text('one.txt')
 
-        with tdir() as d3:
-            f3 = d3 / 'two.txt'
-            f3.write_text('two.txt')
-            assert all(p.is_absolute() for p in (d1, d2, d3))
-            assert d1 != d2 != d3 != d1
+        d3 = Path(tempfile.mkdtemp(dir=d2))
+        f3 = d3 / 'two.txt'
+        f3.write_text('two.txt')
+        assert all(p.is_absolute() for p in (d1, d2, d3))
+        assert d1 != d2 != d3 != d1
 
-            assert f2.exists() and f3.exists()
+        assert f2.exists() and f3.exists()
+        shutil.rmtree(d3)
         assert f2.exists() and not f3.exists()
     assert not f2.exists() and not f3.exists()